@@ -0,0 +1,89 @@
+"""
+   Copyright 2022 Christopher Piggott
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import numba
+import numpy
+
+
+@numba.njit(parallel=True, cache=True)
+def _blend(planes, dirty, out, geom):
+    num_leds = geom[0]
+    num_layers = geom[1]
+    bpp = geom[2]
+    off_r = geom[3]
+    off_g = geom[4]
+    off_b = geom[5]
+
+    size = num_leds * num_layers
+    grn = size
+    blu = size * 2
+    inv_alpha = size * 3
+
+    for led in numba.prange(geom[6], geom[7]):
+        if dirty[led]:
+            r0 = 0
+            g0 = 0
+            b0 = 0
+
+            #
+            # Start from the highest opaque layer, if there is
+            # one, since nothing underneath it can show through
+            #
+            i = led
+            while i < size:
+                if planes[inv_alpha + i] == 0:
+                    r0 = numpy.int64(planes[i])
+                    g0 = numpy.int64(planes[grn + i])
+                    b0 = numpy.int64(planes[blu + i])
+                    break
+                i += num_leds
+
+            #
+            # Every layer above it is blended without checking
+            # whether it is set, premultiplied as in _viper_impl
+            #
+            i -= num_leds
+            while i >= 0:
+                inv = numpy.int64(planes[inv_alpha + i])
+                a1 = 255 - inv
+                t = inv * r0 + 128
+                u = a1 * planes[i] + 128
+                r0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                t = inv * g0 + 128
+                u = a1 * planes[grn + i] + 128
+                g0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                t = inv * b0 + 128
+                u = a1 * planes[blu + i] + 128
+                b0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                i -= num_leds
+
+            o = led * bpp
+            out[o + off_r] = r0
+            out[o + off_g] = g0
+            out[o + off_b] = b0
+            dirty[led] = 0
+
+
+def blend_all(planes, dirty, buf, geom):
+    """
+    Blend every dirty LED straight into the neopixel buffer, with
+    the LEDs spread across all cores.  This takes the same arguments
+    as _viper_impl.blend_all() and does the same calculation; it is
+    what layers.py uses on CPython when numba is installed.
+    """
+    _blend(numpy.frombuffer(planes, dtype=numpy.uint8),
+           numpy.frombuffer(dirty, dtype=numpy.uint8),
+           numpy.frombuffer(buf, dtype=numpy.uint8),
+           numpy.frombuffer(geom, dtype=numpy.uint32).astype(numpy.int64))
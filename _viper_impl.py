@@ -0,0 +1,114 @@
+"""
+   Copyright 2022 Christopher Piggott
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+import micropython
+
+
+@micropython.viper
+def blend_all(planes, dirty, buf, geom):
+    """
+    Blend every dirty LED straight into the neopixel buffer.
+
+    This lives in its own module because a port built without the
+    native emitter refuses to compile anything marked viper, and
+    layers.py needs to be able to import without it.
+
+    :param planes: red, green, blue and inverse alpha planes, each
+                   num_leds * layers bytes, back to back.  Within a
+                   plane, slot layer * num_leds + led.  Slots that
+                   aren't set have an inverse alpha of 255.
+    :param dirty: one byte per LED, non-zero if it needs blending.
+                  Cleared as each LED is blended.
+    :param buf: the neopixel driver's buffer
+    :param geom: array('I') of num_leds, layers, bytes per pixel,
+                 the buffer offsets of red, green and blue, then
+                 the first and one past the last LED to look at
+    """
+    p = ptr8(planes)
+    d = ptr8(dirty)
+    out = ptr8(buf)
+    g = ptr32(geom)
+    num_leds = g[0]
+    num_layers = g[1]
+    bpp = g[2]
+    off_r = g[3]
+    off_g = g[4]
+    off_b = g[5]
+    end = g[7]
+
+    size = num_leds * num_layers
+    grn = size
+    blu = size * 2
+    inv_alpha = size * 3
+
+    led = g[6]
+    while led < end:
+        if d[led]:
+            #
+            # Colors are accumulated premultiplied by alpha,
+            # which needs no divide.  The black background is
+            # opaque so the accumulated alpha stays at 255 and
+            # the premultiplied color is the final color.
+            #
+            r0 = 0
+            g0 = 0
+            b0 = 0
+
+            #
+            # Start from the highest opaque layer, if there is
+            # one, since nothing underneath it can show through
+            #
+            i = led
+            while i < size:
+                if p[inv_alpha + i] == 0:
+                    r0 = p[i]
+                    g0 = p[grn + i]
+                    b0 = p[blu + i]
+                    break
+                i += num_leds
+
+            #
+            # Every layer above it is blended without checking
+            # whether it is set.  An unset slot has an alpha of 0
+            # and passes the color through unchanged.
+            #
+            i -= num_leds
+            while i >= 0:
+                inv = p[inv_alpha + i]
+                a1 = 255 - inv
+
+                #
+                # (t + (t >> 8)) >> 8 with t = x + 128 is
+                # x / 255 rounded to nearest.  Each product is
+                # rounded on its own, as in the Python blend's
+                # table, so both give exactly the same colors.
+                #
+                t = inv * r0 + 128
+                u = a1 * p[i] + 128
+                r0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                t = inv * g0 + 128
+                u = a1 * p[grn + i] + 128
+                g0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                t = inv * b0 + 128
+                u = a1 * p[blu + i] + 128
+                b0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+                i -= num_leds
+
+            o = led * bpp
+            out[o + off_r] = r0
+            out[o + off_g] = g0
+            out[o + off_b] = b0
+            d[led] = 0
+        led += 1
@@ -13,8 +13,137 @@
    See the License for the specific language governing permissions and
    limitations under the License.
 """
+import sys
+from array import array
+
 import neopixel
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# On micropython the blend loop is compiled by the viper
+# emitter where the port supports it.  Elsewhere numba, if it
+# is installed, compiles the same loop and runs it on all cores.
+#
+_blend_native = None
+if sys.implementation.name == "micropython":
+    try:
+        from _viper_impl import blend_all as _blend_native
+    except (ImportError, SyntaxError):
+        pass
+else:
+    try:
+        from _numba_impl import blend_all as _blend_native
+    except ImportError:
+        pass
+
+
+#
+# Source for a blend function unrolled for a fixed number of
+# layers.  It is the same calculation as _blend_into() with the
+# plane offsets and the driver's color order filled in as
+# constants, so there is no loop and no index arithmetic.
+# There is one branch per layer for "this is the highest opaque
+# layer", each blending only the layers above it.
+#
+_UNROLL_MAX_LAYERS = 8
+
+#
+# numpy has a fixed cost per call that only pays for itself once
+# there are a few dozen LEDs to blend.  Below this write() blends
+# one LED at a time, even when numpy is available.
+#
+_NUMPY_MIN_LEDS = 32
+
+_UNROLL_HEAD = """
+def blend_into(led, buf, off):
+    if not depth[led]:
+        r0 = 0
+        g0 = 0
+        b0 = 0
+"""
+
+_UNROLL_OPAQUE = """
+    elif not inv_alpha[led + {start}]:
+        i = led + {start}
+        r0 = red[i]
+        g0 = grn[i]
+        b0 = blu[i]
+"""
+
+_UNROLL_ELSE = """
+    else:
+        r0 = 0
+        g0 = 0
+        b0 = 0
+"""
+
+_UNROLL_LAYER = """
+        i = led + {start}
+        inv = inv_alpha[i]
+        if inv != 255:
+            inv <<= 8
+            a1 = 65280 - inv
+            r0 = mul[inv + r0] + mul[a1 + red[i]]
+            g0 = mul[inv + g0] + mul[a1 + grn[i]]
+            b0 = mul[inv + b0] + mul[a1 + blu[i]]
+"""
+
+_UNROLL_TAIL = """
+    buf[off + {0}] = r0
+    buf[off + {1}] = g0
+    buf[off + {2}] = b0
+"""
+
+
+#
+# _MUL[a * 256 + b] is a * b / 255 rounded, built the first time
+# the Python blend needs it.  64K is a lot of RAM on a small
+# board, which is why it is only built when there is no native
+# blend.  Where there isn't room for it
+# (an ESP8266 has about 40K of heap) _MUL is set to False and
+# the Python blend multiplies instead.
+#
+_MUL = None
+
+
+def _mul_table():
+    global _MUL
+    if _MUL is None:
+        try:
+            mul = bytearray(65536)
+        except MemoryError:
+            _MUL = False
+            return None
+        for a in range(1, 256):
+            row = a * 256
+            for b in range(1, 256):
+                mul[row + b] = (a * b + 127) // 255
+        _MUL = mul
+    return _MUL or None
+
+
+def _quantize_alpha(alpha: float) -> int:
+    """
+    Convert an alpha of 0.0 - 1.0 to an integer 1 - 255.
+
+    An alpha of exactly 0 has always meant opaque rather than
+    invisible, so it becomes 255 here, once, instead of being
+    checked for in the blend.  Anything else above zero stays
+    above zero so that a very faint pixel never rounds down to 0.
+    """
+    if not alpha:
+        return 255
+    a = int(alpha * 255 + 0.5)
+    if a > 255:
+        return 255
+    if a <= 0:
+        return 1
+    return a
+
 
 class LayeredNeoPixel:
     """
@@ -30,19 +159,106 @@ class LayeredNeoPixel:
         :param np: the underlying (physical) neopixel array
         :param layers: number of desired layers (default 4)
         """
-        # Construct the priority array
+        # Construct the priority array.  Each channel lives in its
+        # own flat plane indexed by layer * num_leds + led.  The
+        # planes share one buffer so they can be handed to the
+        # native blend as a single argument.
+        #
+        # Alpha is stored as 255 - alpha, which is what the blend
+        # actually uses.  Since set() never stores an alpha of 0,
+        # an inverse alpha of 255 marks a slot that isn't set.
+        # Blending such a slot leaves the color unchanged, so the
+        # blend doesn't need to check for it.
         num_leds = len(np)
-        self.layers = [[None for i in range(0, layers)] for j in range(0, num_leds)]
+        size = num_leds * layers
+        self._num_leds = num_leds
+        self._num_layers = layers
+        self._planes = bytearray(size * 4)
+        planes = memoryview(self._planes)
+        self._red = planes[0:size]
+        self._grn = planes[size:size * 2]
+        self._blu = planes[size * 2:size * 3]
+        self._inv = planes[size * 3:size * 4]
+        self._inv[:] = b"\xff" * size
         self._np = np
+
+        #
+        # How many slots are set on each LED and on each layer.
+        # An LED with nothing set is painted black without a walk
+        # through its layers, and clearing, fading or blending a
+        # layer that has nothing on it is skipped straight away.
+        #
+        self._depth = array("H", [0] * num_leds)
+        self._layer_count = array("I", [0] * layers)
         self.current_layer = layers - 1
 
+        #
+        # LEDs whose layers changed since the last write().  Only
+        # these get blended again; everything else keeps the value
+        # already sitting in the neopixel driver.  _lo and _hi
+        # bound the dirty LEDs (hi exclusive) so write() only scans
+        # that span; nothing is dirty when _lo >= _hi.  Start with
+        # everything dirty so the first write() paints the strip.
+        #
+        self._dirty = bytearray([1] * num_leds)
+        self._lo = 0
+        self._hi = num_leds
+
+        #
+        # Look at the driver once.  Every blend writes bytes
+        # straight into its buffer, in its color order (GRB for a
+        # WS2812), rather than going through __setitem__.  Drivers
+        # without a buffer get a private RGB one that write()
+        # copies out pixel by pixel.  Drivers older than ORDER
+        # are always GRB.
+        #
+        self._frame = None
+        if hasattr(np, "buf"):
+            self._buf = np.buf
+            self._bpp = np.bpp
+            self._order = np.ORDER if hasattr(np, "ORDER") else (1, 0, 2)
+        else:
+            self._frame = bytearray(num_leds * 3)
+            self._buf = self._frame
+            self._bpp = 3
+            self._order = (0, 1, 2)
+
+        #
+        # The native blend needs the layout of that buffer
+        #
+        self._geom = None
+        if _blend_native is not None:
+            order = self._order
+            self._geom = array("I", [num_leds, layers, self._bpp, order[0], order[1], order[2], 0, 0])
+
+        #
+        # Swap in a blend unrolled for this number of layers
+        # where the layer count is small enough to be worth it.
+        # The native blend never uses it, so don't spend the RAM
+        # on its table there.
+        #
+        if self._geom is None:
+            blend = self._unroll()
+            if blend is not None:
+                self._blend_into = blend
+
+        #
+        # Where numpy is available, wrap the same buffers as
+        # (layer, led) arrays so write() can blend every LED at once
+        #
+        if numpy is not None:
+            self._views = tuple(
+                numpy.frombuffer(b, dtype=numpy.uint8).reshape(layers, num_leds)
+                for b in (self._red, self._grn, self._blu, self._inv))
+            self._buf_view = numpy.frombuffer(self._buf, dtype=numpy.uint8).reshape(num_leds, self._bpp)
+
     def layer(self, layer: int):
         """
         Set the current layer
         :param layer: new current layer
         :return:
         """
-        if layer < 0 or layer > len(self.layers) - 1:
+        if layer < 0 or layer > self._num_layers - 1:
             raise Exception("no such layer")
         self.current_layer = layer
 
@@ -53,17 +269,34 @@ class LayeredNeoPixel:
         :param red:
         :param grn:
         :param blu:
-        :param alpha:
+        :param alpha: 0.0 (exclusive) to 1.0 (opaque).  For historical
+                      reasons 0 also means opaque.
         :param layer: (defaults to bottom most layer)
         :return:
         """
         if layer == -1:
             layer = self.current_layer
-        elif layer >= len(self.layers):
+        elif layer < 0:
+            layer += self._num_layers
+        if not 0 <= layer < self._num_layers:
             raise Exception("priority does not exist")
-        self.layers[led][layer] = (red, grn, blu, alpha)
-
-        self._np[led] = self._alpha_blend(led_num=led)
+        if led < 0:
+            led += self._num_leds
+        if not 0 <= led < self._num_leds:
+            raise Exception("led does not exist")
+        i = layer * self._num_leds + led
+        self._red[i] = int(red)
+        self._grn[i] = int(grn)
+        self._blu[i] = int(blu)
+        if self._inv[i] == 255:
+            self._depth[led] += 1
+            self._layer_count[layer] += 1
+        self._inv[i] = 255 - _quantize_alpha(alpha)
+        self._dirty[led] = 1
+        if led < self._lo:
+            self._lo = led
+        if led >= self._hi:
+            self._hi = led + 1
 
     def setw(self, led: int, red: int, grn: int, blu: int, alpha: int = 1.0, layer: int = -1):
         """
@@ -85,8 +318,36 @@ class LayeredNeoPixel:
         :param layer:
         :return:
         """
-        for i in range(0, len(self.layers)):
-            self.layers[i][layer] = None
+        if layer < 0:
+            layer += self._num_layers
+        if not 0 <= layer < self._num_layers:
+            raise Exception("priority does not exist")
+        if not self._layer_count[layer]:
+            return
+
+        #
+        # Each layer is one contiguous run of the inverse alpha
+        # plane, so it is cleared with a single slice store once
+        # the per-LED counts have been brought up to date
+        #
+        num_leds = self._num_leds
+        start = layer * num_leds
+        inv = self._inv[start:start + num_leds]
+        if numpy is not None:
+            on = numpy.frombuffer(inv, dtype=numpy.uint8) != 255
+            numpy.frombuffer(self._depth, dtype=numpy.uint16)[on] -= 1
+            numpy.frombuffer(self._dirty, dtype=numpy.uint8)[on] = 1
+        else:
+            depth = self._depth
+            dirty = self._dirty
+            for led in range(0, num_leds):
+                if inv[led] != 255:
+                    depth[led] -= 1
+                    dirty[led] = 1
+        inv[:] = b"\xff" * num_leds
+        self._layer_count[layer] = 0
+        self._lo = 0
+        self._hi = num_leds
 
     def relinquishw(self, layer: int):
         """
@@ -124,15 +385,47 @@ class LayeredNeoPixel:
         :param scale: amount to scale by.  0.1 makes the LED 10% dimmer.
         :return:
         """
+        if layer < 0:
+            layer += self._num_layers
+        if not 0 <= layer < self._num_layers:
+            raise Exception("priority does not exist")
+        if not self._layer_count[layer]:
+            return
+
         scale_by = 1.0 - scale
         if scale_by < 0.0:
             scale_by = 0.0
 
-        for led in range(0, len(self._np)):
-            if self.layers[led][layer] is not None:
-                current = self.layers[led][layer]
-                new_alpha = current[3] * scale_by
-                self.set(led, red=current[0], grn=current[1], blu=current[2], alpha=new_alpha, layer=layer)
+        #
+        # Scale as a fraction of 256, rounding down so that every
+        # fade makes a pixel fainter, however small the step.  A
+        # faded pixel never drops below an alpha of 1, even when
+        # faded all the way.
+        #
+        s = int(scale_by * 256)
+        self._lo = 0
+        self._hi = self._num_leds
+
+        if numpy is not None:
+            inv = self._views[3]
+            on = inv[layer] != 255
+            a = numpy.clip(((255 - inv[layer].astype(numpy.int32)) * s) >> 8, 1, 255)
+            inv[layer] = numpy.where(on, 255 - a, 255)
+            numpy.frombuffer(self._dirty, dtype=numpy.uint8)[on] = 1
+            return
+
+        inv = self._inv
+        dirty = self._dirty
+        start = layer * self._num_leds
+        for i in range(start, start + self._num_leds):
+            if inv[i] != 255:
+                a = ((255 - inv[i]) * s) >> 8
+                if a > 255:
+                    a = 255
+                elif not a:
+                    a = 1
+                inv[i] = 255 - a
+                dirty[i - start] = 1
 
     def fadew(self, layer: int, scale: float):
         """
@@ -141,6 +434,10 @@ class LayeredNeoPixel:
         :param scale: amount to scale by.  0.1 makes the LED 10% dimmer.
         :return:
         """
+        if layer < 0:
+            layer += self._num_layers
+        if not 0 <= layer < self._num_layers:
+            raise Exception("priority does not exist")
         self.fade(layer, scale)
         self.write()
 
@@ -158,8 +455,36 @@ class LayeredNeoPixel:
         :param layer: defaults to current layer
         :type layer:
         """
-        for i in range(0, len(self._np)):
-            self.set(i, red, grn, blu, alpha=alpha, layer=layer)
+        if layer == -1:
+            layer = self.current_layer
+        elif layer < 0:
+            layer += self._num_layers
+        if not 0 <= layer < self._num_layers:
+            raise Exception("priority does not exist")
+
+        #
+        # Convert the color and alpha once, then fill the layer's
+        # run of each plane with a single slice store
+        #
+        num_leds = self._num_leds
+        start = layer * num_leds
+        end = start + num_leds
+        inv = self._inv[start:end]
+        if self._layer_count[layer] != num_leds:
+            depth = self._depth
+            for led in range(0, num_leds):
+                if inv[led] == 255:
+                    depth[led] += 1
+            self._layer_count[layer] = num_leds
+
+        self._red[start:end] = bytes([int(red)]) * num_leds
+        self._grn[start:end] = bytes([int(grn)]) * num_leds
+        self._blu[start:end] = bytes([int(blu)]) * num_leds
+        inv[:] = bytes([255 - _quantize_alpha(alpha)]) * num_leds
+
+        self._dirty[:] = b"\x01" * num_leds
+        self._lo = 0
+        self._hi = num_leds
 
     def allw(self, red: int, grn: int, blu: int, alpha: int = 1.0, layer: int = -1):
         """
@@ -181,44 +506,172 @@ class LayeredNeoPixel:
         self.all(red, grn, blu, alpha=alpha, layer=layer)
         self.write()
 
-    def _alpha_blend(self, led_num: int) -> tuple:
-        values = [x for x in self.layers[led_num] if x is not None]
+    def _unroll(self):
+        """
+        Generate and compile a version of _blend_into() specialized
+        for this array's size, layer count and color order.
+        :return: the compiled function, or None if there are too many
+                 layers, there is no room for the table or exec()
+                 isn't available on this port
+        """
+        if self._num_layers > _UNROLL_MAX_LAYERS:
+            return None
+        mul = _mul_table()
+        if mul is None:
+            return None
+
+        num_leds = self._num_leds
+        src = _UNROLL_HEAD
+        for opaque in range(0, self._num_layers):
+            src += _UNROLL_OPAQUE.format(start=opaque * num_leds)
+            for layer in range(opaque - 1, -1, -1):
+                src += _UNROLL_LAYER.format(start=layer * num_leds)
+        src += _UNROLL_ELSE
+        for layer in range(self._num_layers - 1, -1, -1):
+            src += _UNROLL_LAYER.format(start=layer * num_leds)
+        src += _UNROLL_TAIL.format(*self._order)
+
+        ns = {
+            "red": self._red,
+            "grn": self._grn,
+            "blu": self._blu,
+            "inv_alpha": self._inv,
+            "depth": self._depth,
+            "mul": mul,
+        }
+        try:
+            exec(src, ns)
+        except NameError:
+            return None
+        return ns["blend_into"]
 
+    def _blend_into(self, led_num: int, buf, off: int):
+        """
+        Blend one LED and store the result as bytes in buf, in the
+        driver's color order, starting at offset off.  Nothing is
+        allocated, so a full frame creates no garbage.
+        """
         #
-        # The background is solid black
+        # The background is solid black.  Everything here is
+        # integer math with alpha scaled to 0 - 255 so no
+        # floating point is needed (many micropython targets
+        # have no FPU).
         #
-        r0, g0, b0, a0 = 0.0, 0.0, 0.0, 1.0
+        r0, g0, b0 = 0, 0, 0
 
         #
-        # One at a time, layer the next color
-        # on top of the existing color.  This starts
-        # out as the background color but changes
-        # as more and more layers up the stack are
-        # blended in
+        # Every plane is read through a local so each slot is a
+        # single subscript on a flat buffer
         #
-        for layer in reversed(values):
-            r1 = float(layer[0])
-            g1 = float(layer[1])
-            b1 = float(layer[2])
-            a1 = float(layer[3]) or 1.0
+        red = self._red
+        grn = self._grn
+        blu = self._blu
+        inv_alpha = self._inv
+        num_leds = self._num_leds
+        if self._depth[led_num]:
+            #
+            # Look down from the top for an opaque layer.  Nothing
+            # underneath it can show through, so blending starts
+            # there rather than at the background.  For the common
+            # case of a single opaque layer this is the whole job.
+            #
+            i = led_num
+            bottom = self._num_layers * num_leds
+            while i < bottom:
+                if not inv_alpha[i]:
+                    r0 = red[i]
+                    g0 = grn[i]
+                    b0 = blu[i]
+                    break
+                i += num_leds
+
+            #
+            # One at a time, layer the next color
+            # on top of the existing color, working back
+            # up the stack.
+            #
+            # Colors are kept premultiplied by alpha so each layer
+            # is two table lookups per channel, with no multiply or
+            # divide.  Because the background is opaque the total
+            # alpha is always 255, so the premultiplied color is
+            # also the final color.  Without the table the same
+            # two products are worked out and rounded one by one,
+            # so the result is identical.
+            #
+            # An unset slot would pass the color through unchanged
+            # anyway, but in interpreted code skipping it is cheaper
+            # than the lookups (the viper blend doesn't bother).
+            #
+            mul = _mul_table()
+            i -= num_leds
+            if mul is not None:
+                while i >= 0:
+                    inv = inv_alpha[i]
+                    if inv != 255:
+                        inv <<= 8
+                        a1 = 65280 - inv
+                        r0 = mul[inv + r0] + mul[a1 + red[i]]
+                        g0 = mul[inv + g0] + mul[a1 + grn[i]]
+                        b0 = mul[inv + b0] + mul[a1 + blu[i]]
+                    i -= num_leds
+            else:
+                while i >= 0:
+                    inv = inv_alpha[i]
+                    if inv != 255:
+                        a1 = 255 - inv
+                        r0 = (inv * r0 + 127) // 255 + (a1 * red[i] + 127) // 255
+                        g0 = (inv * g0 + 127) // 255 + (a1 * grn[i] + 127) // 255
+                        b0 = (inv * b0 + 127) // 255 + (a1 * blu[i] + 127) // 255
+                    i -= num_leds
+
+        order = self._order
+        buf[off + order[0]] = r0
+        buf[off + order[1]] = g0
+        buf[off + order[2]] = b0
+
+    def _blend_all(self, leds):
+        """
+        Blend a set of LEDs at once using numpy.  This is the same
+        calculation as _blend_into() but each step operates on
+        a whole column of LEDs rather than a single pixel.
+        :param leds: array of LED indexes to blend
+        :return: an array of shape (len(leds), 3) of blended colors
+        """
+        num_leds = len(leds)
+        r0 = numpy.zeros(num_leds, dtype=numpy.int32)
+        g0 = numpy.zeros(num_leds, dtype=numpy.int32)
+        b0 = numpy.zeros(num_leds, dtype=numpy.int32)
 
+        red, grn, blu, inv = self._views
+        layer_count = self._layer_count
+        for layer in range(self._num_layers - 1, -1, -1):
             #
-            # The alpha of the new pixel, but
-            # don't overwrite the existing alpha
-            # as we need it for the calculations
+            # A layer with nothing on it can't change anything.
+            # LEDs that have nothing on this layer have an alpha
+            # of 0 which leaves their color unchanged.
             #
-            a01 = (1.0 - a1) * a0 + a1
+            if not layer_count[layer]:
+                continue
+            a1 = 255 - inv[layer, leds].astype(numpy.int32)
+            w0 = 255 - a1
 
             #
-            # For each color, blend the current color
-            # adjusting for the new total transparency'
+            # Premultiplied, as in _blend_into(), with each product
+            # rounded on its own so the result matches its table
+            # exactly.  t + (t >> 8) >> 8 with t = x + 128 is
+            # x / 255 rounded.
             #
-            r0 = ((1.0 - a1)*a0*r0 + (a1*r1)) / a01
-            g0 = ((1.0 - a1)*a0*g0 + (a1*g1)) / a01
-            b0 = ((1.0 - a1)*a0*b0 + (a1*b1)) / a01
+            t = w0 * r0 + 128
+            u = a1 * red[layer, leds] + 128
+            r0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+            t = w0 * g0 + 128
+            u = a1 * grn[layer, leds] + 128
+            g0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
+            t = w0 * b0 + 128
+            u = a1 * blu[layer, leds] + 128
+            b0 = ((t + (t >> 8)) >> 8) + ((u + (u >> 8)) >> 8)
 
-            a0 = a01
-        return int(r0), int(g0), int(b0)
+        return numpy.stack((r0, g0, b0), axis=1).astype(numpy.uint8)
 
     def write(self):
         """
@@ -226,7 +679,57 @@ class LayeredNeoPixel:
         pixels at once, you can call set() multiple times
         then do a single write() to update the array, rather than
         calling setw() and forcing a hardware refresh each time.
+        Only LEDs that changed since the last write() are blended,
+        and if nothing changed the hardware is not refreshed at all.
         :return: 
         """
-        self._np.write()
+        lo = self._lo
+        hi = self._hi
+        if lo >= hi:
+            return
+
+        dirty = self._dirty
+        buf = self._buf
+        if self._geom is not None:
+            self._geom[6] = lo
+            self._geom[7] = hi
+            _blend_native(self._planes, dirty, buf, self._geom)
+        else:
+            #
+            # Only hand the LEDs to numpy when there are enough of
+            # them to be worth its overhead
+            #
+            leds = range(lo, hi)
+            if numpy is not None and hi - lo >= _NUMPY_MIN_LEDS:
+                leds = numpy.flatnonzero(numpy.frombuffer(dirty, dtype=numpy.uint8)[lo:hi]) + lo
+                if len(leds) >= _NUMPY_MIN_LEDS:
+                    rgb = self._blend_all(leds)
+                    out = self._buf_view
+                    order = self._order
+                    for c in range(0, 3):
+                        out[leds, order[c]] = rgb[:, c]
+                    dirty[lo:hi] = bytes(hi - lo)
+                    leds = ()
+                else:
+                    leds = leds.tolist()
 
+            bpp = self._bpp
+            blend = self._blend_into
+            for i in leds:
+                if dirty[i]:
+                    blend(i, buf, i * bpp)
+                    dirty[i] = 0
+
+        #
+        # A driver without a buffer of its own has to be given
+        # each pixel in the span
+        #
+        frame = self._frame
+        if frame is not None:
+            for i in range(lo, hi):
+                off = i * 3
+                self._np[i] = (frame[off], frame[off + 1], frame[off + 2])
+
+        self._lo = self._num_leds
+        self._hi = 0
+        self._np.write()